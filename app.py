@@ -4,9 +4,21 @@ With Real-Time Agent Activity Visualization & User Authentication
 FIXED VERSION - Proper HTML rendering
 """
 import streamlit as st
+import gzip
+import hmac
 import requests
-import json
+import orjson
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import IntEnum
+from http.cookiejar import DefaultCookiePolicy
+from html import escape
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ===========================================
 # CONFIGURATION
@@ -14,6 +26,13 @@ import time
 API_ENDPOINT = st.secrets.get("API_ENDPOINT", "")
 API_KEY = st.secrets.get("API_KEY", "")
 USER_ACCESS_KEY = st.secrets.get("USER_ACCESS_KEY", "")
+COMPRESS_REQUESTS = bool(st.secrets.get("COMPRESS_REQUESTS", False))  # backend must accept gzip bodies
+GZIP_MIN_BYTES = 1024  # smaller bodies are sent uncompressed
+_HEADERS = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"} if API_KEY else {"Content-Type": "application/json"}
+_STREAM_HEADERS = {**_HEADERS, "Accept": "text/event-stream, application/json"}
+STREAM_FLUSH_INTERVAL = 0.03  # seconds between partial chat redraws
+MESSAGE_WINDOW = 20  # chat messages rendered per page of history
+MAX_MESSAGES = 200  # older messages are dropped from the session
 
 # ===========================================
 # PAGE CONFIGURATION
@@ -28,7 +47,7 @@ st.set_page_config(
 # ===========================================
 # CUSTOM CSS
 # ===========================================
-st.markdown("""
+CSS_STRING = """
 <style>
     .main-header {
         font-size: 2.5rem;
@@ -84,7 +103,29 @@ st.markdown("""
     #MainMenu {visibility: hidden;}
     footer {visibility: hidden;}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+AGENT_FLOW_HTML = """
+<div class="agent-flow">
+    <span class="agent-badge">🎯 Intent</span>
+    <span style="color: #764ba2; font-weight: bold;"> → </span>
+    <span class="agent-badge">📚 RAG</span>
+    <span style="color: #764ba2; font-weight: bold;"> → </span>
+    <span class="agent-badge">📋 Planner</span>
+    <span style="color: #764ba2; font-weight: bold;"> → </span>
+    <span class="agent-badge">📐 Architect</span>
+    <span style="color: #764ba2; font-weight: bold;"> → </span>
+    <span class="agent-badge">💻 Coder</span>
+    <span style="color: #764ba2; font-weight: bold;"> → </span>
+    <span class="agent-badge">🔍 Critic</span>
+</div>
+"""
+
+# Streamlit drops any element not re-emitted during a rerun, so the
+# stylesheet has to be written on every run rather than once per session.
+# Wrapping this in st.cache_resource would not save anything: element calls
+# made inside cached functions are replayed on every cache hit.
+st.markdown(CSS_STRING, unsafe_allow_html=True)
 
 # ===========================================
 # SESSION STATE
@@ -92,9 +133,9 @@ st.markdown("""
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
 if 'session_id' not in st.session_state:
-    st.session_state.session_id = str(int(time.time()))
+    st.session_state.session_id = uuid.uuid4().hex
 if 'context' not in st.session_state:
     st.session_state.context = "medallion_architecture"
 if 'custom_instructions' not in st.session_state:
@@ -103,6 +144,8 @@ if 'login_attempts' not in st.session_state:
     st.session_state.login_attempts = 0
 if 'show_agent_activity' not in st.session_state:
     st.session_state.show_agent_activity = True
+if 'message_window' not in st.session_state:
+    st.session_state.message_window = MESSAGE_WINDOW
 
 # ===========================================
 # AUTHENTICATION
@@ -110,7 +153,7 @@ if 'show_agent_activity' not in st.session_state:
 def verify_access_key(entered_key: str) -> bool:
     if not USER_ACCESS_KEY:
         return True
-    return entered_key == USER_ACCESS_KEY
+    return hmac.compare_digest(entered_key.encode("utf-8"), USER_ACCESS_KEY.encode("utf-8"))
 
 def show_login_page():
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -152,35 +195,194 @@ CONTEXTS = {
     "performance_optimization": {"name": "🚀 Performance", "desc": "Optimize queries", "examples": ["Optimize slow query", "Recommend partitioning"]},
     "custom": {"name": "✨ Custom", "desc": "Any question", "examples": ["Ask anything"]}
 }
+CONTEXT_KEYS = tuple(CONTEXTS.keys())
+
+# ===========================================
+# AGENT STEPS
+# ===========================================
+class StepStatus(IntEnum):
+    PENDING = 0
+    COMPLETED = 1
+    RUNNING = 2
+    ERROR = 3
+
+STATUS_BY_NAME = {"completed": StepStatus.COMPLETED, "running": StepStatus.RUNNING, "error": StepStatus.ERROR}
+STATUS_ICONS = {StepStatus.PENDING: "⏳", StepStatus.COMPLETED: "✅", StepStatus.RUNNING: "🔄", StepStatus.ERROR: "❌"}
+
+@dataclass(slots=True)
+class AgentStep:
+    """One agent step received from the API."""
+    agent: str
+    icon: str
+    action: str
+    status: StepStatus
+    details: tuple
+    status_icon: str = field(init=False)
+    html: str = field(init=False)
+    
+    def __post_init__(self):
+        # Display strings are fixed once received; build them here rather than per rerun
+        self.status_icon = STATUS_ICONS[self.status]
+        # API text is escaped since this is emitted with unsafe_allow_html
+        self.html = (
+            f'<div style="margin-bottom: 0.75rem;">'
+            f'<b>{self.status_icon} {escape(self.icon)} {escape(self.agent)}</b>'
+            f'<br><small>└─ {escape(self.action)}</small>'
+            + "".join(f"<br><small>• {escape(d)}</small>" for d in self.details[:3])
+            + "</div>"
+        )
+    
+    @classmethod
+    def from_dict(cls, raw: dict) -> "AgentStep":
+        # Present-but-null fields fall back to the defaults too
+        return cls(
+            agent=str(raw.get("agent") or "Agent"),
+            icon=str(raw.get("agent_icon") or "🔹"),
+            action=str(raw.get("action") or "Processing"),
+            status=STATUS_BY_NAME.get(raw.get("status") or "completed", StepStatus.PENDING),
+            details=tuple(str(d) for d in raw.get("details") or ())
+        )
 
 # ===========================================
 # API FUNCTIONS
 # ===========================================
-def call_api(operation: str, data: dict):
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared session so keep-alive connections survive script reruns."""
+    session = requests.Session()
+    # The session is shared by every browser session, so never store cookies
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    # Every operation is a POST, which urllib3 only retries on connection errors
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.3)
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def _encode_request(operation: str, data: dict, headers: dict):
+    """Serialize a request body, gzipping large ones when enabled."""
+    body = orjson.dumps({"operation": operation, **data})
+    if COMPRESS_REQUESTS and len(body) > GZIP_MIN_BYTES:
+        return gzip.compress(body), {**headers, "Content-Encoding": "gzip"}
+    return body, headers
+
+def _check_status(response: requests.Response):
+    """Fail on error statuses before any attempt to parse the body as JSON."""
+    if response.status_code >= 400:
+        raise requests.HTTPError(f"HTTP {response.status_code}: {response.text[:200]}", response=response)
+
+def _decode_json(raw):
+    """Parse a JSON body, unwrapping the backend's JSON-encoded-string replies."""
+    body = orjson.loads(raw)
+    return orjson.loads(body) if isinstance(body, str) else body
+
+def _iter_frames(response: requests.Response):
+    """Yield JSON frames from an SSE body, or the whole body if it is plain JSON."""
+    _check_status(response)
+    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+        yield _decode_json(response.content)
+        return
+    
+    # Lines stay as bytes: requests decodes charset-less text/* as latin-1,
+    # while orjson parses the UTF-8 bytes directly.
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            yield {"done": True}
+            break
+        yield _decode_json(payload)
+
+def _stream_api(operation: str, data: dict):
     if not API_ENDPOINT:
         st.error("⚠️ API not configured.")
-        return None
+        return
     
     try:
-        response = requests.post(
+        body, headers = _encode_request(operation, data, _STREAM_HEADERS)
+        with get_http_session().post(
             API_ENDPOINT,
-            json={"operation": operation, **data},
-            headers={"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"},
-            timeout=180
-        )
-        result = response.json()
-        return json.loads(result) if isinstance(result, str) else result
+            data=body,
+            headers=headers,
+            stream=True,
+            timeout=(10, 180)
+        ) as response:
+            yield from _iter_frames(response)
     except Exception as e:
         st.error(f"❌ Error: {str(e)}")
+
+def _post(session: requests.Session, operation: str, data: dict):
+    body, headers = _encode_request(operation, data, _HEADERS)
+    response = session.post(
+        API_ENDPOINT,
+        data=body,
+        headers=headers,
+        timeout=180
+    )
+    _check_status(response)
+    return _decode_json(response.content)
+
+def call_api(operation: str, data: dict, stream: bool = False):
+    if stream:
+        return _stream_api(operation, data)
+    
+    if not API_ENDPOINT:
+        st.error("⚠️ API not configured.")
         return None
+    
+    try:
+        return _post(get_http_session(), operation, data)
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+        return None
+
+def call_api_parallel(*calls: tuple):
+    """Run independent (operation, data) calls concurrently, returning results in order."""
+    if not API_ENDPOINT:
+        st.error("⚠️ API not configured.")
+        return [None] * len(calls)
+    
+    session = get_http_session()
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = [pool.submit(_post, session, operation, data) for operation, data in calls]
+    
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            st.error(f"❌ Error: {str(e)}")
+            results.append(None)
+    return results
 
 def send_chat(message: str):
-    return call_api("chat", {
+    """Yield the chat result as it accumulates from the streamed response."""
+    result = None
+    for frame in call_api("chat", {
         "message": message,
         "session_id": st.session_state.session_id,
         "context": st.session_state.context,
         "custom_instructions": st.session_state.custom_instructions
-    })
+    }, stream=True):
+        if not isinstance(frame, dict):
+            continue
+        if result is None:
+            result = {"response": "", "agent_steps": []}
+        if "agent_step" in frame:
+            result["agent_steps"].append(AgentStep.from_dict(frame["agent_step"]))
+        elif "delta" in frame:
+            result["response"] += frame["delta"]
+        elif frame.get("done"):
+            result.setdefault("success", True)
+        else:
+            result.update(frame)
+            if "agent_steps" in frame:
+                result["agent_steps"] = [AgentStep.from_dict(s) for s in frame["agent_steps"] or []]
+        yield result
 
 def upload_doc(content: str, name: str, context: str):
     return call_api("add_document", {"content": content, "document_name": name, "context": context})
@@ -188,16 +390,26 @@ def upload_doc(content: str, name: str, context: str):
 def get_docs():
     return call_api("get_documents", {})
 
-def get_stats():
-    return call_api("get_stats", {})
+@st.cache_data(ttl=60, show_spinner=False)
+def get_kb_overview():
+    """Fetch stats and the document count together."""
+    stats, docs = call_api_parallel(("get_stats", {}), ("get_documents", {}))
+    if not docs or docs.get("success") is False:
+        return stats, None
+    return stats, len(docs.get("documents") or [])
 
 # ===========================================
 # AGENT ACTIVITY VISUALIZATION (FIXED)
 # ===========================================
-def render_agent_activity(agent_steps: list, is_complete: bool = True):
-    """Render agent activity using native Streamlit components."""
+def summarize_steps(agent_steps: list) -> tuple:
+    """Everything the renderers need from a step list: (steps_html, total, completed)."""
+    completed = sum(1 for s in agent_steps if s.status == StepStatus.COMPLETED)
+    return "".join(step.html for step in agent_steps), len(agent_steps), completed
+
+def render_agent_activity(steps_html: str, total_steps: int, completed: int, is_complete: bool = True):
+    """Render agent activity with all steps in a single HTML markdown block."""
     
-    if not agent_steps:
+    if not total_steps:
         return
     
     # Header
@@ -209,87 +421,65 @@ def render_agent_activity(agent_steps: list, is_complete: bool = True):
         st.markdown(f"### 🤖 Agent Activity {status_emoji}")
         
         # Progress bar
-        total_steps = len(agent_steps)
-        completed = sum(1 for s in agent_steps if s.get("status") == "completed")
         progress = completed / total_steps if total_steps > 0 else 0
         st.progress(progress, text=f"{completed}/{total_steps} steps completed")
         
-        # Render each step in an expander-like format
-        for step in agent_steps:
-            status = step.get("status", "completed")
-            icon = step.get("agent_icon", "🔹")
-            agent = step.get("agent", "Agent")
-            action = step.get("action", "Processing")
-            details = step.get("details", [])
-            
-            # Status styling
-            if status == "completed":
-                status_icon = "✅"
-            elif status == "running":
-                status_icon = "🔄"
-            elif status == "error":
-                status_icon = "❌"
-            else:
-                status_icon = "⏳"
-            
-            # Create a nice display
-            with st.container():
-                st.markdown(f"**{status_icon} {icon} {agent}**")
-                st.caption(f"└─ {action}")
-                
-                # Show details in a subtle way
-                if details:
-                    detail_text = " • ".join(details[:3])
-                    if len(detail_text) > 100:
-                        detail_text = detail_text[:100] + "..."
-                    st.caption(f"   {detail_text}")
+        # All steps go out as a single element
+        st.markdown(steps_html, unsafe_allow_html=True)
         
         st.markdown("---")
 
-def render_agent_activity_expander(agent_steps: list, is_complete: bool = True):
+def render_agent_activity_expander(steps_html: str, total_steps: int, completed: int, is_complete: bool = True):
     """Alternative: Render agent activity in an expander."""
     
-    if not agent_steps:
+    if not total_steps:
         return
     
     status_emoji = "✅" if is_complete else "🔄"
     
-    with st.expander(f"🤖 Agent Activity {status_emoji} ({len(agent_steps)} steps)", expanded=True):
+    with st.expander(f"🤖 Agent Activity {status_emoji} ({total_steps} steps)", expanded=True):
         
         # Progress
-        total_steps = len(agent_steps)
-        completed = sum(1 for s in agent_steps if s.get("status") == "completed")
         st.progress(completed / total_steps if total_steps > 0 else 0)
         st.caption(f"{completed}/{total_steps} steps completed")
         
         st.markdown("---")
         
-        for step in agent_steps:
-            status = step.get("status", "completed")
-            icon = step.get("agent_icon", "🔹")
-            agent = step.get("agent", "Agent")
-            action = step.get("action", "Processing")
-            details = step.get("details", [])
-            
-            # Status icon
-            status_icons = {"completed": "✅", "running": "🔄", "error": "❌"}
-            status_icon = status_icons.get(status, "⏳")
-            
-            # Display
-            col1, col2 = st.columns([1, 4])
-            with col1:
-                st.markdown(f"### {status_icon}")
-            with col2:
-                st.markdown(f"**{icon} {agent}**")
-                st.caption(action)
-                for detail in details[:3]:
-                    st.caption(f"• {detail}")
-            
-            st.markdown("")
+        st.markdown(steps_html, unsafe_allow_html=True)
+
+SUMMARY_LABELS = ("Intent", "Confidence", "Docs Used", "Valid")
+
+def summarize_result(result: dict) -> tuple:
+    """Display values for the Summary metrics, computed once per reply."""
+    intent = result.get("intent")
+    conf = result.get("intent_confidence")
+    validation = result.get("validation") or {}
+    return (
+        intent[:15] if intent else "N/A",
+        f"{conf:.0%}" if conf else "N/A",
+        len(result.get("rag_documents") or []),
+        "✅" if validation.get("passed", True) else "⚠️"
+    )
+
+def render_summary(summary: tuple):
+    with st.expander("📊 Summary"):
+        for col, label, value in zip(st.columns(4), SUMMARY_LABELS, summary):
+            with col:
+                st.metric(label, value)
 
 # ===========================================
 # MAIN APPLICATION
 # ===========================================
+# Button callbacks run before the script, so state changes made here are
+# picked up by the same rerun instead of needing a second st.rerun().
+def clear_chat():
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+    st.session_state.message_window = MESSAGE_WINDOW
+
+def logout():
+    st.session_state.authenticated = False
+    clear_chat()
+
 def show_main_app():
     
     # SIDEBAR
@@ -298,10 +488,7 @@ def show_main_app():
         with col1:
             st.markdown("# 🏗️ DE Agent")
         with col2:
-            if st.button("🚪", help="Logout"):
-                st.session_state.authenticated = False
-                st.session_state.messages = []
-                st.rerun()
+            st.button("🚪", help="Logout", on_click=logout)
         
         st.markdown("---")
         
@@ -309,9 +496,9 @@ def show_main_app():
         st.markdown("## 🎯 Context")
         selected = st.selectbox(
             "Focus",
-            list(CONTEXTS.keys()),
+            CONTEXT_KEYS,
             format_func=lambda x: CONTEXTS[x]["name"],
-            index=list(CONTEXTS.keys()).index(st.session_state.context),
+            index=CONTEXT_KEYS.index(st.session_state.context),
             label_visibility="collapsed"
         )
         st.session_state.context = selected
@@ -320,7 +507,7 @@ def show_main_app():
         
         # Examples
         for i, ex in enumerate(ctx["examples"][:2]):
-            if st.button(f"💡 {ex[:25]}...", key=f"ex_{i}"):
+            if st.button(f"💡 {ex[:25]}...", key=f"ex_{selected}_{i}"):
                 st.session_state.pending_prompt = ex
         
         # Custom instructions
@@ -351,6 +538,7 @@ def show_main_app():
                     with st.spinner("Uploading..."):
                         r = upload_doc(doc_content, doc_name, doc_ctx)
                         if r and r.get("success"):
+                            get_kb_overview.clear()
                             st.success("✅ Added!")
                         else:
                             st.error("Failed")
@@ -358,68 +546,48 @@ def show_main_app():
         col1, col2 = st.columns(2)
         with col1:
             if st.button("📊 Stats"):
-                s = get_stats()
+                s, doc_count = get_kb_overview()
                 if s:
                     st.metric("Docs", s.get("total_documents", 0))
+                if doc_count is not None:
+                    st.metric("Listed", doc_count)
+                if s is None or doc_count is None:
+                    get_kb_overview.clear()
         with col2:
-            if st.button("🗑️ Clear"):
-                st.session_state.messages = []
-                st.rerun()
+            st.button("🗑️ Clear", on_click=clear_chat)
     
     # MAIN CONTENT
     st.markdown('<h1 class="main-header">🏗️ Data Engineering AI Assistant</h1>', unsafe_allow_html=True)
     st.markdown('<p class="sub-header">Powered by Deep Agents • GPT-4o • LangGraph • Azure AI</p>', unsafe_allow_html=True)
     
     # Agent flow
-    st.markdown("""
-    <div class="agent-flow">
-        <span class="agent-badge">🎯 Intent</span>
-        <span style="color: #764ba2; font-weight: bold;"> → </span>
-        <span class="agent-badge">📚 RAG</span>
-        <span style="color: #764ba2; font-weight: bold;"> → </span>
-        <span class="agent-badge">📋 Planner</span>
-        <span style="color: #764ba2; font-weight: bold;"> → </span>
-        <span class="agent-badge">📐 Architect</span>
-        <span style="color: #764ba2; font-weight: bold;"> → </span>
-        <span class="agent-badge">💻 Coder</span>
-        <span style="color: #764ba2; font-weight: bold;"> → </span>
-        <span class="agent-badge">🔍 Critic</span>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(AGENT_FLOW_HTML, unsafe_allow_html=True)
     
-    # Context card
-    ctx = CONTEXTS[st.session_state.context]
+    # Context card (ctx was resolved by the sidebar selectbox above)
     st.markdown(f'<div class="context-card"><strong>Context:</strong> {ctx["name"]} — {ctx["desc"]}</div>', unsafe_allow_html=True)
     
     st.markdown("---")
     
-    # Chat history
-    for msg in st.session_state.messages:
+    # Chat history (only the most recent window is rendered)
+    messages = st.session_state.messages
+    hidden = len(messages) - st.session_state.message_window
+    if hidden > 0 and st.button(f"⬆️ Load older messages ({hidden} hidden)"):
+        st.session_state.message_window += MESSAGE_WINDOW
+        hidden -= MESSAGE_WINDOW
+    for msg in islice(messages, max(hidden, 0), None):
         with st.chat_message(msg["role"]):
             if msg["role"] == "assistant":
                 # Show agent activity
-                if st.session_state.show_agent_activity and msg.get("agent_steps"):
-                    render_agent_activity_expander(msg["agent_steps"], is_complete=True)
+                if st.session_state.show_agent_activity and msg["total_steps"]:
+                    render_agent_activity_expander(
+                        msg["steps_html"], msg["total_steps"], msg["completed_steps"], is_complete=True
+                    )
                 
                 # Show response
                 st.markdown(msg["content"])
                 
                 # Show metadata
-                if msg.get("metadata"):
-                    meta = msg["metadata"]
-                    with st.expander("📊 Summary"):
-                        c1, c2, c3, c4 = st.columns(4)
-                        with c1:
-                            st.metric("Intent", meta.get('intent', 'N/A')[:15] if meta.get('intent') else 'N/A')
-                        with c2:
-                            conf = meta.get('intent_confidence', 0)
-                            st.metric("Confidence", f"{conf:.0%}" if conf else "N/A")
-                        with c3:
-                            docs = meta.get('rag_documents', [])
-                            st.metric("Docs Used", len(docs))
-                        with c4:
-                            val = meta.get('validation', {})
-                            st.metric("Valid", "✅" if val.get('passed', True) else "⚠️")
+                render_summary(msg["summary"])
             else:
                 st.markdown(msg["content"])
     
@@ -439,59 +607,52 @@ def show_main_app():
         
         with st.chat_message("assistant"):
             # Show processing indicator
+            processing_placeholder = st.empty()
             if st.session_state.show_agent_activity:
-                processing_placeholder = st.empty()
                 with processing_placeholder.container():
                     st.info("🔄 **Agents are processing your request...**")
                     st.progress(0.1, text="Starting...")
             
+            # Stream partial activity and response, coalescing redraws
+            result = None
+            last_flush = 0.0
             with st.spinner(""):
-                result = send_chat(prompt)
+                for result in send_chat(prompt):
+                    now = time.monotonic()
+                    if now - last_flush < STREAM_FLUSH_INTERVAL:
+                        continue
+                    last_flush = now
+                    with processing_placeholder.container():
+                        if st.session_state.show_agent_activity and result["agent_steps"]:
+                            render_agent_activity_expander(*summarize_steps(result["agent_steps"]), is_complete=False)
+                        if result["response"]:
+                            st.markdown(result["response"] + "▌")
             
             if result and result.get("success"):
                 response = result.get("response", "")
-                agent_steps = result.get("agent_steps", [])
+                steps_html, total_steps, completed_steps = summarize_steps(result.get("agent_steps", []))
                 
-                # Replace processing with actual activity
-                if st.session_state.show_agent_activity:
-                    processing_placeholder.empty()
-                    if agent_steps:
-                        render_agent_activity_expander(agent_steps, is_complete=True)
-                
-                # Show response
-                st.markdown(response)
+                # Replace partial output with the final activity and response
+                with processing_placeholder.container():
+                    if st.session_state.show_agent_activity and total_steps:
+                        render_agent_activity_expander(steps_html, total_steps, completed_steps, is_complete=True)
+                    st.markdown(response)
                 
                 # Show summary
-                with st.expander("📊 Summary"):
-                    c1, c2, c3, c4 = st.columns(4)
-                    with c1:
-                        intent = result.get('intent', 'N/A')
-                        st.metric("Intent", intent[:15] if intent else 'N/A')
-                    with c2:
-                        conf = result.get('intent_confidence', 0)
-                        st.metric("Confidence", f"{conf:.0%}" if conf else "N/A")
-                    with c3:
-                        docs = result.get('rag_documents', [])
-                        st.metric("Docs Used", len(docs))
-                    with c4:
-                        val = result.get('validation', {})
-                        st.metric("Valid", "✅" if val.get('passed', True) else "⚠️")
+                summary = summarize_result(result)
+                render_summary(summary)
                 
                 # Save to history
                 st.session_state.messages.append({
                     "role": "assistant",
                     "content": response,
-                    "agent_steps": agent_steps,
-                    "metadata": {
-                        "intent": result.get("intent"),
-                        "intent_confidence": result.get("intent_confidence"),
-                        "validation": result.get("validation"),
-                        "rag_documents": result.get("rag_documents", [])
-                    }
+                    "steps_html": steps_html,
+                    "total_steps": total_steps,
+                    "completed_steps": completed_steps,
+                    "summary": summary
                 })
             else:
-                if st.session_state.show_agent_activity:
-                    processing_placeholder.empty()
+                processing_placeholder.empty()
                 error = result.get("error", "Unknown error") if result else "Connection failed"
                 st.error(f"❌ {error}")
     